@@ -19,17 +19,30 @@ This module is used to generate the table of Unicode code point categories
 that are used to parse tokens in Peejay.
 """
 
-from collections.abc import MutableSequence
+from __future__ import annotations
+
+from collections.abc import Iterator
+from dataclasses import dataclass
 from enum import Enum
-from typing import Annotated, Generator, Optional, Sequence
+from typing import Annotated, Optional, TextIO, TYPE_CHECKING
 import argparse
+import hashlib
+import io
+import os
 import pathlib
+import sys
+
+from unicode_data import CodePoint, DbDict, GeneralCategory, MAX_CODE_POINT, read_unicode_data
 
-from unicode_data import CodePoint, CodePointValueDict, DbDict, GeneralCategory, MAX_CODE_POINT, read_unicode_data
+# NumPy is only needed at run time by code_run_array().
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
 
 CodePointBitsType = Annotated[
     int, 'The number of bits used to represent a code point']
 CODE_POINT_BITS: CodePointBitsType = 21
+MAX_ENCODED_CODE_POINT = pow(2, CODE_POINT_BITS) - 1
 
 RunLengthBitsType = Annotated[
     int, 'The number of bits used to represent a run length']
@@ -40,6 +53,10 @@ RuleBitsType = Annotated[int, 'The number of bits used to represent a rule']
 RULE_BITS: RuleBitsType = 2
 MAX_RULE = pow(2, RULE_BITS) - 1
 
+# The rule value used for code points which are not associated with any
+# grammar rule.
+NO_RULE = 0xFF
+
 
 class GrammarRule(Enum):
     whitespace = 0b00
@@ -62,117 +79,144 @@ CATEGORY_TO_GRAMMAR_RULE: dict[GeneralCategory, GrammarRule] = {
 }
 
 
+def _category_to_rule_value() -> tuple[int, ...]:
+    """Builds a table which maps from a GeneralCategory value to the value of
+    the corresponding grammar rule or NO_RULE."""
+
+    table = [NO_RULE] * (max(gc.value for gc in GeneralCategory) + 1)
+    for gc, gr in CATEGORY_TO_GRAMMAR_RULE.items():
+        table[gc.value] = gr.value
+    return tuple(table)
+
+
+_CAT_TO_RULE_VALUE: tuple[int, ...] = _category_to_rule_value()
+
+# Check that the GeneralCategory enumerations used by _SPECIAL_CODE_POINTS will
+# be eventually mapped to the grammar_rule value we expect.
+assert CATEGORY_TO_GRAMMAR_RULE[
+    GeneralCategory.Space_Separator] == GrammarRule.whitespace
+assert CATEGORY_TO_GRAMMAR_RULE[
+    GeneralCategory.Other_Letter] == GrammarRule.identifier_start
+assert CATEGORY_TO_GRAMMAR_RULE[
+    GeneralCategory.Spacing_Mark] == GrammarRule.identifier_part
+
+# Individual code points which are assigned meaning by the ECMAScript grammar
+# and the GeneralCategory value that they must be given in order to be mapped
+# to the correct grammar rule.
+_SPECIAL_CODE_POINTS: tuple[tuple[int, int], ...] = (
+    (0x0009, GeneralCategory.Space_Separator.value),
+    (0x000A, GeneralCategory.Space_Separator.value),
+    (0x000B, GeneralCategory.Space_Separator.value),
+    (0x000C, GeneralCategory.Space_Separator.value),
+    (0x000D, GeneralCategory.Space_Separator.value),
+    (0x0020, GeneralCategory.Space_Separator.value),
+    (0x0024, GeneralCategory.Other_Letter.value),
+    (0x005F, GeneralCategory.Other_Letter.value),
+    (0x00A0, GeneralCategory.Space_Separator.value),
+    (0x200C, GeneralCategory.Spacing_Mark.value),
+    (0x200D, GeneralCategory.Spacing_Mark.value),
+    (0xFEFF, GeneralCategory.Space_Separator.value),
+)
+
+
+# The comment suffix which names each grammar rule, indexed by its value.
+_RULE_SUFFIX: dict[int, str] = {x.value: f'({x.name})' for x in GrammarRule}
+
+
 class OutputRow:
     """An individual output row representing a run of unicode code points
     which all belong to the same rule."""
 
+    __slots__ = ('_code_point', '_length', '_category', '_name')
+
     def __init__(self, code_point: CodePoint, length: int,
-                 category: GrammarRule):
-        assert code_point < pow(2, CODE_POINT_BITS)
-        self.__code_point: CodePoint = code_point
-        assert length < pow(2, RUN_LENGTH_BITS)
-        self.__length: int = length
-        assert category.value < pow(2, RULE_BITS)
-        self.__category: GrammarRule = category
-
-    def as_str(self, db: DbDict) -> str:
-        return '{{ 0x{0:04x}, {1}, {2} }}, // {3} ({4})'\
-            .format(self.__code_point, self.__length, self.__category.value,
-                    db[self.__code_point]['Name'], self.__category.name)
-
-
-class CRAState:
-    """A class used to model the state of code_run_array() as it processes
-    each unicode code point in sequence."""
-
-    def __init__(self) -> None:
-        self.__first: CodePoint = CodePoint(0)
-        self.__length: int = 0
-        self.__max_length: int = 0
-        self.__cat: Optional[GrammarRule] = None
-
-    def new_run(self, code_point: CodePoint,
-                mc: Optional[GrammarRule]) -> None:
-        """Start a new potential run of contiguous code points.
-
-        :param code_point: The code point at which the run may start.
-        :param mc: The rule associated with this code point or None.
-        :return: None
-        """
-
-        self.__first = code_point
-        self.__cat = mc
-        self.__length = int(mc is not None)
-
-    def extend_run(self, mc: Optional[GrammarRule]) -> bool:
-        """Adds a code point to the current run or indicates that a new run
-        should be started.
-
-        :param mc:
-        :return: True if the current run was extended or False if a new run
-                 should be started.
-        """
-
-        if self.__cat is not None and mc == self.__cat:
-            if self.__length > MAX_RUN_LENGTH:
-                return False
-            self.__length += 1
-            self.__max_length = max(self.__max_length, self.__length)
-            return True
-        return False
-
-    def end_run(
-            self,
-            result: MutableSequence[OutputRow]) -> MutableSequence[OutputRow]:
-        """Call at the end of a contiguous run of entries. If there are new
-        values, a new Entry will be appended to the 'result' sequence.
-
-        :param result: The sequence to which a new entry may be appended.
-        :return: The value 'result'.
-        """
-
-        if self.__length > 0 and self.__cat is not None:
-            assert self.__first <= MAX_CODE_POINT
-            assert self.__length <= MAX_RUN_LENGTH
-            assert self.__cat.value <= MAX_RULE
-            result.append(OutputRow(self.__first, self.__length, self.__cat))
-        return result
-
-    def max_run(self) -> int:
-        """The length of the longest contiguous run that has been encountered."""
-        return self.__max_length
-
-
-def all_code_points() -> Generator[CodePoint, None, None]:
-    """A generator which yields all of the valid Unicode code points in
-    sequence."""
-
-    code_point = CodePoint(0)
-    while code_point <= MAX_CODE_POINT:
-        yield code_point
-        code_point = CodePoint(code_point + 1)
-
-
-def code_run_array(db: DbDict) -> list[OutputRow]:
-    """Produces an array of code runs from the Unicode database dictionary.
+                 category: GrammarRule, name: str):
+        # These checks use precomputed limits because they run for every row.
+        # Like all assertions, they are skipped when Python is run with -O.
+        assert code_point <= MAX_ENCODED_CODE_POINT
+        self._code_point: CodePoint = code_point
+        assert length <= MAX_RUN_LENGTH
+        self._length: int = length
+        assert category.value <= MAX_RULE
+        self._category: GrammarRule = category
+        self._name: str = name
+
+    def as_str(self) -> str:
+        value = self._category.value
+        return (f'{{ 0x{self._code_point:04x}, {self._length}, {value} }}, '
+                f'// {self._name} {_RULE_SUFFIX[value]}')
+
+
+@dataclass
+class RunTable:
+    """A table of runs of unicode code points which all belong to the same
+    rule. The table is held as parallel arrays, one element per run, sorted by
+    code point."""
+
+    first: npt.NDArray[np.uint32]
+    length: npt.NDArray[np.uint16]
+    rule: npt.NDArray[np.uint8]
+    names: list[str]
+
+    def __len__(self) -> int:
+        return len(self.first)
+
+    def rows(self) -> Iterator[OutputRow]:
+        """A generator which yields an OutputRow for each run in the table."""
+
+        for f, n, r, name in zip(self.first.tolist(), self.length.tolist(),
+                                 self.rule.tolist(), self.names):
+            yield OutputRow(CodePoint(f), n, GrammarRule(r), name)
+
+
+def code_run_array(db: DbDict) -> RunTable:
+    """Produces a table of code runs from the Unicode database dictionary.
 
     :param db: The Unicode database dictionary.
-    :return: An array of code point runs.
+    :return: A table of code point runs.
     """
 
-    state = CRAState()
-    code_runs: list[OutputRow] = list()
-    for code_point in all_code_points():
-        mc: Optional[GrammarRule] = None
-        v: Optional[CodePointValueDict] = db.get(code_point)
-        if v is not None:
-            mc = CATEGORY_TO_GRAMMAR_RULE.get(v['General_Category'])
-            if state.extend_run(mc):
-                continue
-        state.end_run(code_runs)
-        state.new_run(code_point, mc)
-    state.end_run(code_runs)
-    return code_runs
+    # NumPy is imported here rather than at the top of the module so that a
+    # cached header can be copied without it.
+    import numpy as np
+
+    # The code points in the database, in ascending order, along with the value
+    # of the grammar rule associated with each of them. Those code points which
+    # are not associated with a grammar rule are discarded.
+    code_points = np.fromiter(db.keys(), dtype=np.int32, count=len(db))
+    cats = np.fromiter(
+        (_CAT_TO_RULE_VALUE[v['General_Category'].value] for v in db.values()),
+        dtype=np.uint8,
+        count=len(db))
+    order = np.argsort(code_points, kind='stable')
+    code_points = code_points[order]
+    cats = cats[order]
+    keep = cats != NO_RULE
+    code_points = code_points[keep]
+    cats = cats[keep]
+
+    # A run starts wherever there is a gap in the code points or the rule
+    # changes.
+    starts = np.ones(len(code_points), dtype=bool)
+    starts[1:] = (np.diff(code_points) != 1) | (np.diff(cats) != 0)
+    starts = np.flatnonzero(starts)
+    firsts = code_points[starts]
+    lengths = np.diff(np.append(starts, len(code_points)))
+    rules = cats[starts]
+
+    # Split any run which is too long to be represented into pieces of no more
+    # than MAX_RUN_LENGTH code points.
+    pieces = (lengths + MAX_RUN_LENGTH - 1) // MAX_RUN_LENGTH
+    run = np.repeat(np.arange(len(firsts)), pieces)
+    # The offset of each piece from the start of the run from which it came.
+    offset = (np.arange(len(run)) -
+              np.repeat(np.cumsum(pieces) - pieces, pieces)) * MAX_RUN_LENGTH
+    firsts = firsts[run] + offset
+    lengths = np.minimum(lengths[run] - offset, MAX_RUN_LENGTH)
+    return RunTable(first=firsts.astype(np.uint32),
+                    length=lengths.astype(np.uint16),
+                    rule=rules[run],
+                    names=[db[f]['Name'] for f in firsts.tolist()])
 
 
 def patch_special_code_points(db: DbDict) -> DbDict:
@@ -185,30 +229,8 @@ def patch_special_code_points(db: DbDict) -> DbDict:
     :return: The Unicode database dictionary.
     """
 
-    # Check that the GeneralCategory enumerations will be eventually mapped to
-    # the grammar_rule value we expect.
-    assert CATEGORY_TO_GRAMMAR_RULE[
-        GeneralCategory.Space_Separator] == GrammarRule.whitespace
-    assert CATEGORY_TO_GRAMMAR_RULE[
-        GeneralCategory.Other_Letter] == GrammarRule.identifier_start
-    assert CATEGORY_TO_GRAMMAR_RULE[
-        GeneralCategory.Spacing_Mark] == GrammarRule.identifier_part
-    special_code_points = {
-        CodePoint(0x0009): GeneralCategory.Space_Separator,
-        CodePoint(0x000A): GeneralCategory.Space_Separator,
-        CodePoint(0x000B): GeneralCategory.Space_Separator,
-        CodePoint(0x000C): GeneralCategory.Space_Separator,
-        CodePoint(0x000D): GeneralCategory.Space_Separator,
-        CodePoint(0x0020): GeneralCategory.Space_Separator,
-        CodePoint(0x0024): GeneralCategory.Other_Letter,
-        CodePoint(0x005F): GeneralCategory.Other_Letter,
-        CodePoint(0x00A0): GeneralCategory.Space_Separator,
-        CodePoint(0x200C): GeneralCategory.Spacing_Mark,
-        CodePoint(0x200D): GeneralCategory.Spacing_Mark,
-        CodePoint(0xFEFF): GeneralCategory.Space_Separator
-    }
-    for cp, cat in special_code_points.items():
-        db[cp]['General_Category'] = cat
+    for cp, gc_value in _SPECIAL_CODE_POINTS:
+        db[cp]['General_Category'] = GeneralCategory(gc_value)
     return db
 
 
@@ -217,42 +239,116 @@ def dump_db(db: DbDict) -> None:
         print('U+{0:04x} {1}'.format(k, v))
 
 
-def emit_header(entries: Sequence[OutputRow], include_guard: str) -> None:
-    """Emits a C++ header file which declares the array variable along with the
-    necessary types.
+def header_prologue(include_guard: str) -> str:
+    """Returns the text which opens a generated C++ header file: the include
+    guard, the namespace, and the declaration of the grammar_rule enumeration.
 
-    :param entries: A sequence of OutputRow instances sorted by code point.
     :param include_guard: The name of the header file include guard to be used.
-    :return: None
+    :return: The header text.
     """
-    print('// This file was auto-generated. DO NOT EDIT!')
-    print('#ifndef {0}'.format(include_guard))
-    print('#define {0}'.format(include_guard))
-    print('''
+    enumerators = ',\n'.join(
+        [f'  {x.name} = 0b{x.value:0>2b}' for x in GrammarRule])
+    return f'''// This file was auto-generated. DO NOT EDIT!
+#ifndef {include_guard}
+#define {include_guard}
+
 #include <array>
 #include <cstdint>
 
-namespace peejay {
+namespace peejay {{
 
-enum class grammar_rule : std::uint8_t {''')
-    print(',\n'.join(
-        ['  {0} = 0b{1:0>2b}'.format(x.name, x.value) for x in GrammarRule]))
-    print('''}};
+enum class grammar_rule : std::uint8_t {{
+{enumerators}
+}};
 constexpr auto idmask = 0b01U;
-struct cprun {{
-  std::uint_least32_t code_point: {0};
-  std::uint_least32_t length: {1};
-  std::uint_least32_t rule: {2};
-}};'''.format(CODE_POINT_BITS, RUN_LENGTH_BITS, RULE_BITS))
+'''
+
+
+def header_epilogue(include_guard: str) -> str:
+    """Returns the text which closes a generated C++ header file.
+
+    :param include_guard: The name of the header file include guard to be used.
+    :return: The header text.
+    """
+    return f'''
+}} // end namespace peejay
+#endif // {include_guard}
+'''
+
+
+def emit_header(entries: RunTable,
+                include_guard: str,
+                out: Optional[TextIO] = None) -> None:
+    """Emits a C++ header file which declares the array variable along with the
+    necessary types.
+
+    :param entries: The table of code point runs.
+    :param include_guard: The name of the header file include guard to be used.
+    :param out: The stream to which the header is written (by default,
+                sys.stdout).
+    :return: None
+    """
     assert CODE_POINT_BITS + RUN_LENGTH_BITS + RULE_BITS <= 32
+    w = (sys.stdout if out is None else out).write
+    w(header_prologue(include_guard))
+    w(f'''struct cprun {{
+  std::uint_least32_t code_point: {CODE_POINT_BITS};
+  std::uint_least32_t length: {RUN_LENGTH_BITS};
+  std::uint_least32_t rule: {RULE_BITS};
+}};
+inline std::array<cprun, {len(entries)}> const code_point_runs = {{{{
+''')
+    for x in entries.rows():
+        w('  ')
+        w(x.as_str())
+        w('\n')
+    w('}};\n')
+    w(header_epilogue(include_guard))
+
+
+def cache_path(cache_dir: pathlib.Path, unicode_data: pathlib.Path,
+               *options: str) -> pathlib.Path:
+    """Returns the path of the cached header generated from a UnicodeData.txt
+    file. The file name is derived from the contents of the Unicode data, the
+    source of the generator, and the options which affect its output so a
+    change to any of them selects a different file.
+
+    :param cache_dir: The directory which holds cached header files.
+    :param unicode_data: The path of the UnicodeData.txt file.
+    :param options: The command-line options which affect the output.
+    :return: The path of the cached header file (which may not exist).
+    """
+
+    h = hashlib.sha256()
+    h.update(unicode_data.read_bytes())
+    here = pathlib.Path(__file__).resolve().parent
+    for source in ('parse.py', 'unicode_data.py'):
+        h.update((here / source).read_bytes())
+    for option in options:
+        h.update(option.encode() + b'\0')
+    return cache_dir / 'cprun-{0}.hpp'.format(h.hexdigest())
 
-    print('inline std::array<cprun, {0}> const code_point_runs = {{{{'.format(
-        len(entries)))
-    for x in entries:
-        print('  {0}'.format(x.as_str(db)))
-    print('}};')
-    print('\n} // end namespace peejay')
-    print('#endif // {0}'.format(include_guard))
+
+def write_cache(path: pathlib.Path, text: str) -> None:
+    """Saves a generated header in the cache and removes any other (stale)
+    cached headers from its directory. Failure to write the cache is not an
+    error: the header is simply regenerated next time.
+
+    :param path: The path of the cached header file.
+    :param text: The contents of the generated header.
+    :return: None
+    """
+
+    temp = path.with_suffix('.tmp{0}'.format(os.getpid()))
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp.write_text(text)
+        os.replace(temp, path)
+        for stale in path.parent.glob('cprun-*.hpp'):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+    except OSError:
+        temp.unlink(missing_ok=True)
 
 
 if __name__ == '__main__':
@@ -270,6 +366,14 @@ if __name__ == '__main__':
     parser.add_argument('--include-guard',
                         help='the name of header file include guard macro',
                         default='CPRUN_HPP')
+    parser.add_argument('--cache-dir',
+                        help='a directory in which to cache the generated '
+                        'header (by default, no cache is used)',
+                        type=pathlib.Path)
+    parser.add_argument('--no-cache',
+                        help='regenerate the header even if the cache '
+                        'directory holds a copy',
+                        action='store_true')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-d',
@@ -278,10 +382,20 @@ if __name__ == '__main__':
                        action='store_true')
 
     args = parser.parse_args()
-    db = read_unicode_data(args.unicode_data)
     if args.dump:
-        dump_db(db)
+        dump_db(read_unicode_data(args.unicode_data))
     else:
-        db = patch_special_code_points(db)
-        entries = code_run_array(db)
-        emit_header(entries, args.include_guard)
+        path = None
+        if args.cache_dir is not None:
+            path = cache_path(args.cache_dir, args.unicode_data,
+                              args.include_guard)
+        if path is not None and not args.no_cache and path.is_file():
+            sys.stdout.write(path.read_text())
+        else:
+            db = patch_special_code_points(
+                read_unicode_data(args.unicode_data))
+            buf = io.StringIO()
+            emit_header(code_run_array(db), args.include_guard, buf)
+            sys.stdout.write(buf.getvalue())
+            if path is not None:
+                write_cache(path, buf.getvalue())